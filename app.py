@@ -1,53 +1,223 @@
+import asyncio
 import os
+import re
 import time
-import uuid
+import secrets
 import hashlib
-from typing import Dict, List
+import hmac
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Set, Tuple
 
 from fastapi import (
+    Depends,
     FastAPI,
+    Header,
     WebSocket,
     WebSocketDisconnect,
     UploadFile,
     File,
     HTTPException,
 )
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+import aiofiles
 import certifi
-from pymongo import MongoClient, ASCENDING
+import orjson
+import redis.asyncio as aioredis
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import (
+    BulkWriteError,
+    ConnectionFailure,
+    DuplicateKeyError,
+    OperationFailure,
+)
+from pymongo.write_concern import WriteConcern
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOADS_DIR = os.path.join(APP_DIR, "uploads")
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
+# hashlib.pbkdf2_hmac is backed by OpenSSL's PKCS5_PBKDF2_HMAC, which already
+# dispatches to SHA-NI / ARMv8 SHA extensions where the CPU has them.
+PBKDF2_ITERATIONS = 120_000
+
+DEFAULT_ROOM = "general"
+HISTORY_LIMIT = 200
+BROADCAST_BATCH = 64
+TOKEN_TTL = 7 * 24 * 3600
+TOKEN_CACHE_TTL = 300
+WS_AUTH_TIMEOUT = 10
+TOKEN_CACHE_MAX = 10_000
+WRITE_BATCH_MAX = 100
+WRITE_BATCH_WAIT = 0.02
+MESSAGE_MAX_CHARS = 4000
+FIELD_MAX_CHARS = 256
+WRITE_RETRIES = 5
+WRITE_RETRY_DELAY = 0.5
+CLOCK_TICK = 0.05
+UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+UPLOAD_CHUNK = 1 << 16
+# Room for the multipart boundaries and headers around the file itself.
+UPLOAD_REQUEST_MAX_BYTES = UPLOAD_MAX_BYTES + UPLOAD_CHUNK
+# Uploads are named by their SHA-256, so a URL's content never changes.
+UPLOAD_CACHE_CONTROL = "public, max-age=604800, immutable"
+CHAT_CHANNEL = "massg:chat"
+LOGOUT_CHANNEL = "massg:logout"
+
 MONGODB_URI = os.environ.get("MONGODB_URI", "").strip()
 MONGODB_DB = os.environ.get("MONGODB_DB", "massg").strip() or "massg"
 MONGODB_TLS_INSECURE = os.environ.get("MONGODB_TLS_INSECURE", "").strip().lower() in {"1", "true", "yes"}
+# Set to 0 when a reverse proxy (see nginx.conf) serves /static and /uploads.
+SERVE_STATIC = os.environ.get("SERVE_STATIC", "1").strip().lower() in {"1", "true", "yes"}
+# Optional; when set, messages and logouts fan out to every worker over Redis pub/sub.
+REDIS_URL = os.environ.get("REDIS_URL", "").strip()
 if not MONGODB_URI:
     raise RuntimeError("MONGODB_URI is required. Set it in your environment.")
 
-mongo = MongoClient(
+mongo = AsyncIOMotorClient(
     MONGODB_URI,
     tlsCAFile=certifi.where(),
     tlsAllowInvalidCertificates=MONGODB_TLS_INSECURE,
     tlsAllowInvalidHostnames=MONGODB_TLS_INSECURE,
+    maxPoolSize=200,
+    minPoolSize=10,
+    maxIdleTimeMS=300_000,
+    retryWrites=True,
+    compressors="zstd,zlib",
 )
 db = mongo[MONGODB_DB]
 users = db["users"]
 tokens = db["tokens"]
-messages = db["messages"]
+# Chat messages don't need majority durability; users and tokens keep the default.
+messages = db.get_collection("messages", write_concern=WriteConcern(w=1, j=False))
 
-users.create_index([("username", ASCENDING)], unique=True)
-tokens.create_index([("token", ASCENDING)], unique=True)
-messages.create_index([("created_at", ASCENDING)])
+_redis = aioredis.Redis.from_url(REDIS_URL) if REDIS_URL else None
 
-app = FastAPI()
-app.mount(
-    "/static", StaticFiles(directory=os.path.join(APP_DIR, "static")), name="static"
-)
-app.mount("/uploads", StaticFiles(directory=UPLOADS_DIR), name="uploads")
+_IMAGE_EXTENSIONS = {".png": "png", ".jpg": "jpeg", ".jpeg": "jpeg", ".gif": "gif", ".webp": "webp"}
+
+_ROOM_RE = re.compile(r"[a-z0-9_-]{1,32}")
+
+_MESSAGE_FIELDS = {
+    "_id": 0,
+    "id": 1,
+    "room": 1,
+    "username": 1,
+    "text": 1,
+    "image_url": 1,
+    "created_at": 1,
+}
+
+# token -> (username, expires_at); insertion-ordered, so the first key is the oldest.
+_token_cache: Dict[str, Tuple[str, float]] = {}
+
+# pbkdf2_hmac releases the GIL inside OpenSSL, so threads hash on all cores
+# without the pickling and fork overhead of a process pool. A dedicated pool
+# keeps a burst of logins from starving the default executor.
+_pbkdf2_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="pbkdf2")
+
+# Newest messages per room in memory so connecting clients don't hit MongoDB.
+# Every delivered message is appended, including ones relayed from other
+# workers; a room's buffer is dropped when its last subscriber leaves.
+_recent: Dict[str, Deque[Dict]] = {}
+
+# Per-room delivery queues fed by _relay; each room's consumer task sends in
+# order, so a stalled socket only holds up its own room.
+_room_queues: Dict[str, "asyncio.Queue[Tuple[Dict, str]]"] = {}
+_room_consumers: Set["asyncio.Task[None]"] = set()
+
+# Wall-clock seconds refreshed by _tick, so hot paths skip a time() call per write.
+_now = [int(time.time())]
+
+# Messages accepted by this worker but not yet stored, by id, so a room buffer
+# reloaded from MongoDB doesn't miss them. Messages still pending on other
+# workers aren't visible here.
+_pending: Dict[str, Dict] = {}
+
+# Messages waiting to be bulk-inserted; None tells the writer to stop.
+_message_queue: "asyncio.Queue[Optional[Dict]]" = asyncio.Queue()
+
+logger = logging.getLogger("massg")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await users.create_index([("username", ASCENDING)], unique=True)
+    await tokens.create_index([("token", ASCENDING)], unique=True)
+    await tokens.create_index([("created_at", ASCENDING)], expireAfterSeconds=TOKEN_TTL)
+    await messages.create_index([("id", ASCENDING)], unique=True)
+    await messages.create_index(
+        [("room", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]
+    )
+    # Superseded by the room index; drop them where older deployments still have them.
+    for name in ("created_at_1", "created_at_-1_id_-1"):
+        try:
+            await messages.drop_index(name)
+        except OperationFailure:
+            pass
+    ticker = asyncio.create_task(_tick())
+    writer = asyncio.create_task(_message_writer())
+    relay = asyncio.create_task(_relay()) if _redis is not None else None
+    yield
+    if relay is not None:
+        relay.cancel()
+    _message_queue.put_nowait(None)
+    await writer
+    ticker.cancel()
+    if _redis is not None:
+        await _redis.aclose()
+    _pbkdf2_pool.shutdown()
+
+
+class UploadFiles(StaticFiles):
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = UPLOAD_CACHE_CONTROL
+        return response
+
+
+# Rejects oversized /api/upload bodies while they stream in, before Starlette
+# spools the multipart form to disk.
+class UploadSizeLimit:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/api/upload":
+            await self.app(scope, receive, send)
+            return
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > UPLOAD_REQUEST_MAX_BYTES:
+            response = JSONResponse({"detail": "File too large"}, status_code=413)
+            await response(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > UPLOAD_REQUEST_MAX_BYTES:
+                    # Raised inside form parsing; FastAPI turns it into the 413 response.
+                    raise HTTPException(status_code=413, detail="File too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(UploadSizeLimit)
+if SERVE_STATIC:
+    app.mount(
+        "/static", StaticFiles(directory=os.path.join(APP_DIR, "static")), name="static"
+    )
+    app.mount("/uploads", UploadFiles(directory=UPLOADS_DIR), name="uploads")
 
 
 class AuthPayload(BaseModel):
@@ -55,150 +225,465 @@ class AuthPayload(BaseModel):
     password: str
 
 
-def _pbkdf2_hash(password: str, salt: bytes) -> str:
-    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 120_000).hex()
+def _sniff_image(head: bytes) -> Optional[str]:
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
 
+def _pbkdf2_hash(password: str, salt: bytes) -> bytes:
+    return hashlib.pbkdf2_hmac(
+        "sha256", password.encode("utf-8"), salt, PBKDF2_ITERATIONS
+    )
+
+
+async def _hash_password(password: str, salt: bytes) -> bytes:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pbkdf2_pool, _pbkdf2_hash, password, salt)
 
-def _create_user(username: str, password: str) -> None:
+
+async def _create_user(username: str, password: str) -> None:
     salt = os.urandom(16)
-    hashed = _pbkdf2_hash(password, salt)
-    users.insert_one(
+    hashed = await _hash_password(password, salt)
+    await users.insert_one(
         {
             "username": username,
-            "salt": salt.hex(),
+            "salt": salt,
             "hash": hashed,
-            "created_at": int(time.time()),
+            "created_at": _now[0],
         }
     )
 
 
-def _verify_user(username: str, password: str) -> bool:
-    row = users.find_one({"username": username})
+async def _verify_user(username: str, password: str) -> bool:
+    row = await users.find_one({"username": username}, {"_id": 0, "salt": 1, "hash": 1})
     if not row:
         return False
-    salt = bytes.fromhex(row["salt"])
-    expected = row["hash"]
-    return _pbkdf2_hash(password, salt) == expected
+    salt, expected = row["salt"], row["hash"]
+    legacy = isinstance(salt, str)
+    if legacy:
+        # Accounts created before salt and hash were stored as BinData.
+        salt, expected = bytes.fromhex(salt), bytes.fromhex(expected)
+    if not hmac.compare_digest(await _hash_password(password, salt), expected):
+        return False
+    if legacy:
+        await users.update_one(
+            {"username": username}, {"$set": {"salt": salt, "hash": expected}}
+        )
+    return True
 
 
-def _issue_token(username: str) -> str:
-    token = uuid.uuid4().hex
-    tokens.insert_one(
-        {"token": token, "username": username, "created_at": int(time.time())}
+async def _issue_token(username: str) -> str:
+    token = secrets.token_hex(16)
+    await tokens.insert_one(
+        {
+            "token": token,
+            "username": username,
+            # TTL indexes only expire BSON dates, not epoch integers.
+            "created_at": datetime.fromtimestamp(_now[0], timezone.utc),
+        }
     )
     return token
 
 
-def _auth_username(token: str) -> str:
-    row = tokens.find_one({"token": token})
+async def _auth_username(token: str) -> str:
+    now = time.monotonic()
+    cached = _token_cache.get(token)
+    if cached and cached[1] > now:
+        return cached[0]
+    row = await tokens.find_one({"token": token}, {"_id": 0, "username": 1})
     if not row:
+        _token_cache.pop(token, None)
         raise HTTPException(status_code=401, detail="Invalid token")
+    _token_cache.pop(token, None)
+    if len(_token_cache) >= TOKEN_CACHE_MAX:
+        del _token_cache[next(iter(_token_cache))]
+    _token_cache[token] = (row["username"], now + TOKEN_CACHE_TTL)
     return row["username"]
 
 
-def _store_message(username: str, text: str, image_url: str) -> Dict:
+def _bearer_token(authorization: str = Header("")) -> str:
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+    return token.strip()
+
+
+async def _current_username(token: str = Depends(_bearer_token)) -> str:
+    return await _auth_username(token)
+
+
+def _check_room(room: str) -> str:
+    if not _ROOM_RE.fullmatch(room):
+        raise HTTPException(status_code=400, detail="Invalid room")
+    return room
+
+
+def _room_filter(room: str) -> Dict:
+    # Messages stored before rooms existed have no room and belong to the default one.
+    if room == DEFAULT_ROOM:
+        return {"room": {"$in": [DEFAULT_ROOM, None]}}
+    return {"room": room}
+
+
+def _str_field(data: Dict, key: str, max_chars: int = FIELD_MAX_CHARS) -> Optional[str]:
+    value = data.get(key) or ""
+    if not isinstance(value, str) or len(value) > max_chars:
+        return None
+    try:
+        # JSON frames can carry lone surrogates, which orjson refuses to encode.
+        value.encode("utf-8")
+    except UnicodeEncodeError:
+        return None
+    return value.strip()
+
+
+def _store_message(username: str, room: str, text: str, image_url: str) -> Dict:
     msg = {
-        "id": uuid.uuid4().hex,
+        "id": secrets.token_hex(16),
+        "room": room,
         "username": username,
         "text": text,
         "image_url": image_url,
-        "created_at": int(time.time()),
+        "created_at": _now[0],
     }
-    messages.insert_one(msg)
+    # insert_many adds an ObjectId _id to the documents it is given; keep msg JSON-safe.
+    _message_queue.put_nowait(dict(msg))
+    _pending[msg["id"]] = msg
     return msg
 
 
+async def _tick() -> None:
+    while True:
+        _now[0] = int(time.time())
+        await asyncio.sleep(CLOCK_TICK)
+
+
+async def _message_writer() -> None:
+    while True:
+        batch = [await _message_queue.get()]
+        await asyncio.sleep(WRITE_BATCH_WAIT)
+        while len(batch) < WRITE_BATCH_MAX and not _message_queue.empty():
+            batch.append(_message_queue.get_nowait())
+        docs = [doc for doc in batch if doc is not None]
+        if docs:
+            try:
+                await _insert_messages(docs)
+            except Exception:
+                logger.exception("Failed to store %d messages", len(docs))
+            for doc in docs:
+                _pending.pop(doc["id"], None)
+        if len(docs) != len(batch):
+            return
+
+
+async def _insert_messages(docs: List[Dict]) -> None:
+    for attempt in range(WRITE_RETRIES):
+        try:
+            await messages.insert_many(docs, ordered=False)
+            return
+        except BulkWriteError as exc:
+            # Duplicate keys mean an earlier attempt already stored that document.
+            errors = exc.details.get("writeErrors", [])
+            docs = [docs[err["index"]] for err in errors if err.get("code") != 11000]
+            if not docs:
+                return
+        except ConnectionFailure:
+            pass
+        except Exception:
+            # Not transient, e.g. a document bson can't encode.
+            if len(docs) == 1:
+                logger.exception("Dropping message %s that cannot be stored", docs[0]["id"])
+                return
+            break
+        if attempt + 1 < WRITE_RETRIES:
+            await asyncio.sleep(WRITE_RETRY_DELAY * 2**attempt)
+    else:
+        logger.error("Failed to store %d messages after %d attempts", len(docs), WRITE_RETRIES)
+        return
+    # Split the batch so the bad message is dropped and the rest are still stored.
+    middle = len(docs) // 2
+    await _insert_messages(docs[:middle])
+    await _insert_messages(docs[middle:])
+
+
+async def _history(room: str, before_id: str = "") -> List[Dict]:
+    query = _room_filter(room)
+    if before_id:
+        anchor = await messages.find_one({"id": before_id}, {"_id": 0, "created_at": 1})
+        if not anchor:
+            return []
+        created_at = anchor["created_at"]
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": before_id}},
+        ]
+    rows = await (
+        messages.find(query, _MESSAGE_FIELDS)
+        .sort([("created_at", DESCENDING), ("id", DESCENDING)])
+        .limit(HISTORY_LIMIT)
+        .batch_size(HISTORY_LIMIT)
+        .to_list(length=HISTORY_LIMIT)
+    )
+    rows.reverse()
+    return rows
+
+
+async def _room_recent(room: str) -> Deque[Dict]:
+    recent = _recent.get(room)
+    if recent is None:
+        rows = await _history(room)
+        seen = {row["id"] for row in rows}
+        rows.extend(
+            msg for msg in _pending.values() if msg["room"] == room and msg["id"] not in seen
+        )
+        rows.sort(key=lambda row: (row["created_at"], row["id"]))
+        # Another connection may have filled the buffer while we awaited.
+        recent = _recent.setdefault(room, deque(rows, maxlen=HISTORY_LIMIT))
+    return recent
+
+
 @app.get("/")
 def index():
     return FileResponse(os.path.join(APP_DIR, "static", "index.html"))
 
 
 @app.post("/api/register")
-def register(payload: AuthPayload):
+async def register(payload: AuthPayload):
     username = payload.username.strip()
     if not username or not payload.password:
         raise HTTPException(status_code=400, detail="Missing username or password")
-    if users.find_one({"username": username}):
+    if await users.find_one({"username": username}, {"_id": 1}):
         raise HTTPException(status_code=409, detail="Username already exists")
-    _create_user(username, payload.password)
-    token = _issue_token(username)
+    try:
+        await _create_user(username, payload.password)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Username already exists")
+    token = await _issue_token(username)
     return {"token": token, "username": username}
 
 
 @app.post("/api/login")
-def login(payload: AuthPayload):
+async def login(payload: AuthPayload):
     username = payload.username.strip()
     if not username or not payload.password:
         raise HTTPException(status_code=400, detail="Missing username or password")
-    if not _verify_user(username, payload.password):
+    if not await _verify_user(username, payload.password):
         raise HTTPException(status_code=401, detail="Invalid username or password")
-    token = _issue_token(username)
+    token = await _issue_token(username)
     return {"token": token, "username": username}
 
 
+@app.get("/api/history")
+async def history(
+    room: str = DEFAULT_ROOM,
+    before_id: str = "",
+    _: str = Depends(_current_username),
+):
+    return {"messages": await _history(_check_room(room), before_id)}
+
+
+@app.post("/api/logout")
+async def logout(token: str = Depends(_bearer_token)):
+    _token_cache.pop(token, None)
+    await tokens.delete_one({"token": token})
+    if _redis is not None:
+        try:
+            await _redis.publish(LOGOUT_CHANNEL, token)
+        except aioredis.RedisError:
+            # Other workers drop the token from their caches within TOKEN_CACHE_TTL.
+            logger.exception("Redis publish failed for logout")
+    return {"ok": True}
+
+
 @app.post("/api/upload")
-def upload_image(token: str, file: UploadFile = File(...)):
-    _ = _auth_username(token)
+async def upload_image(
+    file: UploadFile = File(...), _: str = Depends(_current_username)
+):
     if not file.filename:
         raise HTTPException(status_code=400, detail="No file")
     ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in [".png", ".jpg", ".jpeg", ".gif", ".webp"]:
+    if ext not in _IMAGE_EXTENSIONS:
         raise HTTPException(status_code=400, detail="Unsupported file type")
-    name = f"{uuid.uuid4().hex}{ext}"
+    kind = _IMAGE_EXTENSIONS[ext]
+    head = await file.read(12)
+    if _sniff_image(head) != kind:
+        raise HTTPException(status_code=400, detail="File content does not match its type")
+    # Stream to a temp file while hashing, then name the upload by its content.
+    digest = hashlib.sha256(head)
+    tmp_path = os.path.join(UPLOADS_DIR, f".{secrets.token_hex(16)}.part")
+    written = len(head)
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            await f.write(head)
+            while chunk := await file.read(UPLOAD_CHUNK):
+                written += len(chunk)
+                if written > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                digest.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        # aiofiles.open may have failed before the file existed.
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+    name = f"{digest.hexdigest()}.{kind}"
     path = os.path.join(UPLOADS_DIR, name)
-    with open(path, "wb") as f:
-        f.write(file.file.read())
+    if os.path.exists(path):
+        os.unlink(tmp_path)
+    else:
+        os.replace(tmp_path, path)
     return {"image_url": f"/uploads/{name}"}
 
 
 class ConnectionManager:
     def __init__(self):
-        self.active: List[WebSocket] = []
+        self.active: Dict[str, Set[WebSocket]] = {}
+
+    def connect(self, ws: WebSocket, room: str):
+        self.active.setdefault(room, set()).add(ws)
+
+    def disconnect(self, ws: WebSocket, room: str):
+        subscribers = self.active.get(room)
+        if subscribers is None:
+            return
+        subscribers.discard(ws)
+        if not subscribers:
+            del self.active[room]
+
+    async def broadcast_text(self, room: str, payload: str):
+        clients = list(self.active.get(room, ()))
+        for i in range(0, len(clients), BROADCAST_BATCH):
+            batch = clients[i : i + BROADCAST_BATCH]
+            results = await asyncio.gather(
+                *(ws.send_text(payload) for ws in batch), return_exceptions=True
+            )
+            for ws, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.disconnect(ws, room)
+            # Let other connections' handlers run between batches.
+            await asyncio.sleep(0)
 
-    async def connect(self, ws: WebSocket):
-        await ws.accept()
-        self.active.append(ws)
 
-    def disconnect(self, ws: WebSocket):
-        if ws in self.active:
-            self.active.remove(ws)
+manager = ConnectionManager()
 
-    async def broadcast(self, data: Dict):
-        for ws in list(self.active):
-            try:
-                await ws.send_json(data)
-            except Exception:
-                self.disconnect(ws)
 
+async def _deliver(room: str, msg: Dict, client_id: str) -> None:
+    # Serialize first so a message that can't be encoded never reaches the buffer.
+    echo = {**msg, "client_id": client_id} if client_id else msg
+    payload = orjson.dumps({"type": "message", "message": echo}).decode()
+    if room in _recent:
+        _recent[room].append(msg)
+    await manager.broadcast_text(room, payload)
 
-manager = ConnectionManager()
+
+async def _publish(room: str, msg: Dict, client_id: str) -> None:
+    if _redis is None:
+        await _deliver(room, msg, client_id)
+        return
+    # Every worker, this one included, delivers it from _relay.
+    try:
+        await _redis.publish(
+            CHAT_CHANNEL, orjson.dumps({"room": room, "message": msg, "client_id": client_id})
+        )
+    except aioredis.RedisError:
+        logger.exception("Redis publish failed; delivering locally")
+        await _deliver(room, msg, client_id)
+
+
+def _enqueue_delivery(room: str, msg: Dict, client_id: str) -> None:
+    queue = _room_queues.get(room)
+    if queue is None:
+        queue = _room_queues[room] = asyncio.Queue()
+        task = asyncio.create_task(_room_consumer(room, queue))
+        _room_consumers.add(task)
+        task.add_done_callback(_room_consumers.discard)
+    queue.put_nowait((msg, client_id))
+
+
+async def _room_consumer(room: str, queue: "asyncio.Queue[Tuple[Dict, str]]") -> None:
+    while True:
+        msg, client_id = await queue.get()
+        await _deliver(room, msg, client_id)
+        if queue.empty():
+            del _room_queues[room]
+            return
+
+
+async def _relay() -> None:
+    while True:
+        try:
+            async with _redis.pubsub() as pubsub:
+                await pubsub.subscribe(CHAT_CHANNEL, LOGOUT_CHANNEL)
+                # Anything published while we were unsubscribed is missing from
+                # the buffers; drop them so the next connect reloads from MongoDB.
+                _recent.clear()
+                async for event in pubsub.listen():
+                    if event["type"] != "message":
+                        continue
+                    if event["channel"] == LOGOUT_CHANNEL.encode():
+                        _token_cache.pop(event["data"].decode(), None)
+                        continue
+                    data = orjson.loads(event["data"])
+                    room = data["room"]
+                    if room in manager.active or room in _room_queues:
+                        _enqueue_delivery(room, data["message"], data["client_id"])
+        except Exception:
+            logger.exception("Redis relay failed; resubscribing")
+            await asyncio.sleep(1)
 
 
 @app.websocket("/ws")
-async def websocket_endpoint(ws: WebSocket, token: str):
+async def websocket_endpoint(ws: WebSocket, room: str = DEFAULT_ROOM):
+    if not _ROOM_RE.fullmatch(room):
+        await ws.close(code=1008)
+        return
+    # Browsers can't set headers on a WebSocket handshake, so the token
+    # arrives in the first frame instead of the URL.
+    await ws.accept()
     try:
-        username = _auth_username(token)
-    except HTTPException:
+        data = await asyncio.wait_for(ws.receive_json(), WS_AUTH_TIMEOUT)
+        token = data.get("token") if isinstance(data, dict) else None
+        username = await _auth_username(str(token or ""))
+    except WebSocketDisconnect:
+        return
+    # receive_json raises KeyError on a binary frame and ValueError on bad JSON.
+    except (asyncio.TimeoutError, KeyError, ValueError, HTTPException):
         await ws.close(code=1008)
         return
 
-    await manager.connect(ws)
-
-    history = list(messages.find({}, {"_id": 0}).sort("created_at", ASCENDING))
-    await ws.send_json({"type": "history", "messages": history})
+    recent = await _room_recent(room)
+    manager.connect(ws, room)
 
     try:
+        await ws.send_text(
+            orjson.dumps({"type": "history", "messages": list(recent)}).decode()
+        )
         while True:
-            data = await ws.receive_json()
-            text = (data.get("text") or "").strip()
-            image_url = (data.get("image_url") or "").strip()
-            client_id = (data.get("client_id") or "").strip()
+            try:
+                data = await ws.receive_json()
+            except (KeyError, ValueError):
+                continue
+            if not isinstance(data, dict):
+                continue
+            text = _str_field(data, "text", MESSAGE_MAX_CHARS)
+            image_url = _str_field(data, "image_url")
+            client_id = _str_field(data, "client_id")
+            if text is None or image_url is None or client_id is None:
+                continue
             if not text and not image_url:
                 continue
-            msg = _store_message(username, text, image_url)
-            if client_id:
-                msg["client_id"] = client_id
-            await manager.broadcast({"type": "message", "message": msg})
+            msg = _store_message(username, room, text, image_url)
+            await _publish(room, msg, client_id)
     except WebSocketDisconnect:
-        manager.disconnect(ws)
-        return
+        pass
+    finally:
+        manager.disconnect(ws, room)
+        if room not in manager.active:
+            _recent.pop(room, None)
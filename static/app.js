@@ -14,18 +14,29 @@ const imageInput = document.getElementById("imageInput");
 const sendBtn = document.getElementById("sendBtn");
 const emojiToggle = document.getElementById("emojiToggle");
 const emojiPanel = document.getElementById("emojiPanel");
+const logoutBtn = document.getElementById("logoutBtn");
 
 let ws = null;
 let token = localStorage.getItem("token") || "";
 let username = localStorage.getItem("username") || "";
+const ROOM_RE = /^[a-z0-9_-]{1,32}$/;
+const requestedRoom = (new URLSearchParams(location.search).get("room") || "").toLowerCase();
+// Same rule as the server; an invalid name would be refused on every reconnect.
+const room = ROOM_RE.test(requestedRoom) ? requestedRoom : "general";
 const pendingByClientId = new Map();
 const sendQueue = [];
 let reconnectTimer = null;
+let oldestId = "";
+let loadingOlder = false;
 
 function setError(msg) {
   authError.textContent = msg || "";
 }
 
+function authHeaders() {
+  return { Authorization: `Bearer ${token}` };
+}
+
 function showAuth() {
   authView.classList.remove("hidden");
   chatView.classList.add("hidden");
@@ -52,6 +63,11 @@ function addMessage(msg) {
     return;
   }
 
+  messagesEl.appendChild(renderMessage(msg));
+  messagesEl.scrollTop = messagesEl.scrollHeight;
+}
+
+function renderMessage(msg) {
   const div = document.createElement("div");
   div.className = "message" + (msg.username === username ? " me" : "");
   const meta = document.createElement("div");
@@ -66,8 +82,39 @@ function addMessage(msg) {
     img.src = msg.image_url;
     div.appendChild(img);
   }
-  messagesEl.appendChild(div);
-  messagesEl.scrollTop = messagesEl.scrollHeight;
+  return div;
+}
+
+async function loadOlder() {
+  if (loadingOlder || !oldestId) return;
+  loadingOlder = true;
+  try {
+    const res = await fetch(`/api/history?room=${encodeURIComponent(room)}&before_id=${oldestId}`, {
+      headers: authHeaders()
+    });
+    if (res.status === 401) {
+      expireSession();
+      return;
+    }
+    const data = await res.json();
+    if (!res.ok) return;
+    if (data.messages.length === 0) {
+      oldestId = "";
+      return;
+    }
+    oldestId = data.messages[0].id;
+    const prevHeight = messagesEl.scrollHeight;
+    const frag = document.createDocumentFragment();
+    data.messages.forEach((msg) => {
+      if (msg.username !== "system") frag.appendChild(renderMessage(msg));
+    });
+    messagesEl.prepend(frag);
+    messagesEl.scrollTop += messagesEl.scrollHeight - prevHeight;
+  } catch (err) {
+    console.error("[HISTORY] load failed", err);
+  } finally {
+    loadingOlder = false;
+  }
 }
 
 async function loginOrRegister(endpoint, payload) {
@@ -96,7 +143,7 @@ async function loginOrRegister(endpoint, payload) {
 
 function wsUrl() {
   const proto = location.protocol === "https:" ? "wss" : "ws";
-  return `${proto}://${location.host}/ws?token=${token}`;
+  return `${proto}://${location.host}/ws?room=${encodeURIComponent(room)}`;
 }
 
 function connectWS() {
@@ -104,10 +151,15 @@ function connectWS() {
   ws = new WebSocket(wsUrl());
   ws.onopen = () => {
     console.log("[WS] connected");
+    ws.send(JSON.stringify({ token }));
     flushQueue();
   };
-  ws.onclose = () => {
+  ws.onclose = (ev) => {
     console.warn("[WS] closed");
+    if (ev.code === 1008) {
+      expireSession();
+      return;
+    }
     scheduleReconnect();
   };
   ws.onerror = (e) => {
@@ -118,6 +170,7 @@ function connectWS() {
       const payload = JSON.parse(ev.data);
       if (payload.type === "history") {
         messagesEl.innerHTML = "";
+        oldestId = payload.messages.length ? payload.messages[0].id : "";
         payload.messages.forEach(addMessage);
       } else if (payload.type === "message") {
         addMessage(payload.message);
@@ -129,7 +182,7 @@ function connectWS() {
 }
 
 function scheduleReconnect() {
-  if (reconnectTimer) return;
+  if (reconnectTimer || !token) return;
   reconnectTimer = setTimeout(() => {
     reconnectTimer = null;
     connectWS();
@@ -155,7 +208,11 @@ async function sendMessage() {
   if (imageInput.files && imageInput.files[0]) {
     const form = new FormData();
     form.append("file", imageInput.files[0]);
-    const res = await fetch(`/api/upload?token=${token}`, { method: "POST", body: form });
+    const res = await fetch("/api/upload", { method: "POST", headers: authHeaders(), body: form });
+    if (res.status === 401) {
+      expireSession();
+      return;
+    }
     const data = await res.json();
     if (res.ok) {
       image_url = data.image_url;
@@ -193,6 +250,39 @@ async function sendMessage() {
   textInput.value = "";
 }
 
+function clearSession() {
+  token = "";
+  username = "";
+  localStorage.removeItem("token");
+  localStorage.removeItem("username");
+  sendQueue.length = 0;
+  pendingByClientId.clear();
+  oldestId = "";
+  clearTimeout(reconnectTimer);
+  reconnectTimer = null;
+  if (ws) ws.close();
+  messagesEl.innerHTML = "";
+  showAuth();
+}
+
+function expireSession() {
+  clearSession();
+  setError("Session expired. Please log in again.");
+}
+
+async function logout() {
+  const oldToken = token;
+  clearSession();
+  try {
+    await fetch("/api/logout", {
+      method: "POST",
+      headers: { Authorization: `Bearer ${oldToken}` }
+    });
+  } catch (err) {
+    console.error("[AUTH] logout failed", err);
+  }
+}
+
 loginForm.addEventListener("submit", (e) => {
   e.preventDefault();
   loginOrRegister("/api/login", {
@@ -210,6 +300,10 @@ registerForm.addEventListener("submit", (e) => {
 });
 
 sendBtn.addEventListener("click", sendMessage);
+logoutBtn.addEventListener("click", logout);
+messagesEl.addEventListener("scroll", () => {
+  if (messagesEl.scrollTop === 0) loadOlder();
+});
 textInput.addEventListener("keydown", (e) => {
   if (e.key === "Enter") sendMessage();
 });